@@ -1,8 +1,17 @@
 import os
-import datetime
+import concurrent.futures
+import csv
+import hashlib
+import io
+import mmap
 import time
+import numpy as np
 import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from pgvector.psycopg2 import register_vector
 import google.genai as genai
+from google.genai import errors as genai_errors
 from dotenv import load_dotenv
 from pypdf import PdfReader
 from pypdf.errors import PdfReadError
@@ -17,8 +26,65 @@ SCHEMA_NAME = "HomeTask_beforebone"
 TABLE_NAME = "document_embeddings"
 FULL_TABLE_NAME = f'"{SCHEMA_NAME}".{TABLE_NAME}'
 
+EMBEDDING_MODEL = "text-embedding-004"
+EMBEDDING_DIM = 768
+# Per-request limits for embed_content: item count and total characters.
+EMBED_BATCH_SIZE = 100
+EMBED_BATCH_MAX_CHARS = 20_000
+# Number of embed_content requests allowed in flight at once.
+MAX_IN_FLIGHT_BATCHES = 5
+# PDFs with fewer pages than this are extracted in-process; a pool isn't worth spawning.
+PDF_PARALLEL_MIN_PAGES = 8
+# Chunks shorter than this ("Page 1", headings, separators) are merged into the next one.
+MIN_CHUNK_CHARS = 20
+# Files with at least this many rows are loaded with COPY instead of batched INSERTs.
+COPY_MIN_ROWS = 2000
+
+
+def _chunk_hash(text):
+    """Content hash used to find chunks that were already embedded."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _to_pgvector(embedding):
+    """Formats an embedding as a pgvector text literal, e.g. '[0.1,0.2]'."""
+    return "[" + ",".join(map(str, embedding.tolist())) + "]"
+
+
+def _extract_pages(reader, page_indices, file_path):
+    """Extracts text for the given pages, returning (page_index, text) pairs."""
+    results = []
+    for i in page_indices:
+        try:
+            extracted = reader.pages[i].extract_text() or ""
+        except Exception as e:
+            # Skip problematic pages instead of failing the whole file
+            print(f"Warning: failed extracting text from page {i} in {file_path}: {e}")
+            extracted = ""
+        results.append((i, extracted))
+    return results
+
+
+def _extract_pdf_pages(file_path, page_indices):
+    """Process pool worker: re-opens the PDF, since readers can't be shared across processes."""
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return _extract_pages(PdfReader(mm), page_indices, file_path)
+
 
 class DocumentVectorizer:
+    # Per-file statements, composed once with properly quoted identifiers
+    _TABLE = sql.Identifier(SCHEMA_NAME, TABLE_NAME)
+    _INSERT_EMPTY_SQL = sql.SQL(
+        "INSERT INTO {} (chunk_text, embedding, file_name, split_strategy) VALUES (%s, %s, %s, %s)"
+    ).format(_TABLE)
+    _INSERT_SQL = sql.SQL(
+        "INSERT INTO {} (chunk_text, embedding, file_name, split_strategy, chunk_hash) VALUES %s"
+    ).format(_TABLE)
+    _COPY_SQL = sql.SQL(
+        "COPY {} (chunk_text, embedding, file_name, split_strategy, chunk_hash) "
+        "FROM STDIN WITH (FORMAT csv, DELIMITER E'\\t')"
+    ).format(_TABLE)
+
     def __init__(self, db_url):
         if not db_url:
             raise ValueError("DATABASE_URL is missing/empty.")
@@ -31,118 +97,255 @@ class DocumentVectorizer:
 
     def _init_db(self):
         table_query = f"""
+        CREATE EXTENSION IF NOT EXISTS vector;
         CREATE SCHEMA IF NOT EXISTS "{SCHEMA_NAME}";
         CREATE TABLE IF NOT EXISTS {FULL_TABLE_NAME} (
             id SERIAL PRIMARY KEY,
             chunk_text TEXT NOT NULL,
-            embedding FLOAT8[] NOT NULL,
+            embedding vector({EMBEDDING_DIM}),
             file_name TEXT NOT NULL,
             split_strategy TEXT NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
+        ALTER TABLE {FULL_TABLE_NAME} ADD COLUMN IF NOT EXISTS chunk_hash TEXT;
+        DO $$
+        BEGIN
+            -- Tables created before the switch to pgvector store FLOAT8[] embeddings
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = '{SCHEMA_NAME}' AND table_name = '{TABLE_NAME}'
+                  AND column_name = 'embedding' AND data_type = 'ARRAY'
+            ) THEN
+                ALTER TABLE {FULL_TABLE_NAME} ALTER COLUMN embedding DROP NOT NULL;
+                ALTER TABLE {FULL_TABLE_NAME} ALTER COLUMN embedding TYPE vector({EMBEDDING_DIM})
+                    USING CASE WHEN cardinality(embedding) = 0 THEN NULL
+                               ELSE embedding::vector({EMBEDDING_DIM}) END;
+            END IF;
+        END $$;
+        CREATE INDEX IF NOT EXISTS {TABLE_NAME}_chunk_hash_idx ON {FULL_TABLE_NAME} (chunk_hash);
+        CREATE INDEX IF NOT EXISTS {TABLE_NAME}_embedding_idx
+            ON {FULL_TABLE_NAME} USING hnsw (embedding vector_cosine_ops);
+        """
+        # Prepared once per connection; process_file runs it for every file
+        lookup_query = f"""
+        PREPARE lookup_embeddings (TEXT[]) AS
+        SELECT DISTINCT ON (chunk_hash) chunk_hash, embedding
+        FROM {FULL_TABLE_NAME}
+        WHERE chunk_hash = ANY($1)
         """
         with self.conn, self.conn.cursor() as cur:
             cur.execute(table_query)
+            cur.execute(lookup_query)
+            register_vector(self.conn)
 
-    def extract_text(self, file_path):
-        """Extracts text from PDF or DOCX files."""
+    def _extract_pdf_parallel(self, file_path):
+        """Extracts PDF page texts, spreading page ranges across a process pool for larger files."""
+        # Read through a read-only memory map, so pages come from the OS page cache
+        with open(file_path, "rb") as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as e:
+                # mmap rejects zero-byte files
+                raise ValueError(f"Failed to read PDF: {file_path}") from e
+
+            with mm:
+                try:
+                    reader = PdfReader(mm)
+                except PdfReadError as e:
+                    raise ValueError(f"Failed to read PDF: {file_path}") from e
+
+                if getattr(reader, "is_encrypted", False):
+                    raise ValueError(f"PDF is encrypted and cannot be processed: {file_path}")
+
+                num_pages = len(reader.pages)
+                workers = min(os.cpu_count() or 1, num_pages)
+
+                pages = [""] * num_pages
+                if num_pages < PDF_PARALLEL_MIN_PAGES or workers < 2:
+                    for i, text in _extract_pages(reader, range(num_pages), file_path):
+                        pages[i] = text
+                else:
+                    # One contiguous page range per worker, so each process parses the file once
+                    step = -(-num_pages // workers)
+                    ranges = [range(start, min(start + step, num_pages)) for start in range(0, num_pages, step)]
+                    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                        futures = [executor.submit(_extract_pdf_pages, file_path, r) for r in ranges]
+                        for future in concurrent.futures.as_completed(futures):
+                            for i, text in future.result():
+                                pages[i] = text
+
+        return [text for text in pages if text.strip()]
+
+    def _iter_sections(self, file_path):
+        """Yields the text of each non-blank PDF page or DOCX paragraph, in order."""
         if not os.path.exists(file_path):
             raise FileNotFoundError(file_path)
 
         ext = os.path.splitext(file_path)[1].lower()
-        text = ""
 
         if ext == ".pdf":
-            try:
-                reader = PdfReader(file_path)
-            except PdfReadError as e:
-                raise ValueError(f"Failed to read PDF: {file_path}") from e
-
-            if getattr(reader, "is_encrypted", False):
-                raise ValueError(f"PDF is encrypted and cannot be processed: {file_path}")
-
-            for i, page in enumerate(reader.pages):
-                try:
-                    extracted = page.extract_text() or ""
-                except Exception as e:
-                    # Skip problematic pages instead of failing the whole file
-                    print(f"Warning: failed extracting text from page {i} in {file_path}: {e}")
-                    extracted = ""
-                if extracted.strip():
-                    text += extracted + "\n\n"
-
+            yield from self._extract_pdf_parallel(file_path)
         elif ext == ".docx":
             try:
                 doc = Document(file_path)
             except Exception as e:
                 raise ValueError(f"Failed to read DOCX: {file_path}") from e
 
-            text = "\n\n".join([para.text for para in doc.paragraphs if para.text.strip()])
+            yield from (para.text for para in doc.paragraphs if para.text.strip())
         else:
             raise ValueError(f"Unsupported file format: {ext}")
 
-        return text.strip()
+    def extract_text(self, file_path):
+        """Extracts text from PDF or DOCX files."""
+        return "\n\n".join(self._iter_sections(file_path)).strip()
+
+    def iter_chunks(self, file_path):
+        """Yields chunks page by page / paragraph by paragraph, without building the full text."""
+        chunks = (chunk for section in self._iter_sections(file_path) for chunk in self.chunk_text(section))
+        yield from self._merge_short_chunks(chunks)
+
+    def _merge_short_chunks(self, chunks, min_chars=MIN_CHUNK_CHARS):
+        """Merges chunks shorter than min_chars into the following chunk."""
+        buffer = ""
+        for chunk in chunks:
+            buffer = f"{buffer}\n\n{chunk}" if buffer else chunk
+            if len(buffer) >= min_chars:
+                yield buffer
+                buffer = ""
+        if buffer:
+            yield buffer
 
     def chunk_text(self, text):
-        chunks = [c.strip() for c in text.split("\n\n") if c.strip()]
-        return chunks
+        return [s for s in (c.strip() for c in text.split("\n\n")) if s]
 
-    def get_embedding(self, text, *, max_retries=3, base_delay_s=1.0):
-        """Generates embedding using Gemini API with basic retry/backoff."""
-        if not text or not text.strip():
-            return []
+    def _iter_batches(self, texts, batch_size=EMBED_BATCH_SIZE, max_chars=EMBED_BATCH_MAX_CHARS):
+        """Groups texts into batches bounded by item count and total characters."""
+        batch, batch_chars = [], 0
+        for text in texts:
+            if batch and (len(batch) >= batch_size or batch_chars + len(text) > max_chars):
+                yield batch
+                batch, batch_chars = [], 0
+            batch.append(text)
+            batch_chars += len(text)
+        if batch:
+            yield batch
 
+    def _embed_with_retry(self, batch, *, max_retries=3, base_delay_s=1.0):
+        """Embeds one batch in a single API call with basic retry/backoff."""
         last_err = None
         for attempt in range(1, max_retries + 1):
             try:
-                response = self.client.models.embed_content(model="text-embedding-004", contents=text)
-                return response.embeddings[0].values
+                response = self.client.models.embed_content(model=EMBEDDING_MODEL, contents=batch)
+                return [np.asarray(e.values, dtype=np.float32) for e in response.embeddings]
+            except genai_errors.ClientError as e:
+                # 429 is rate limiting and is retried like server errors; any other
+                # 4xx won't succeed on a resend, so leave it to the caller
+                if e.code != 429:
+                    raise
+                last_err = e
             except Exception as e:
                 last_err = e
-                if attempt < max_retries:
-                    sleep_s = base_delay_s * (2 ** (attempt - 1))
-                    time.sleep(sleep_s)
-                else:
-                    raise RuntimeError(f"Embedding failed after {max_retries} attempts.") from last_err
+            if attempt < max_retries:
+                sleep_s = base_delay_s * (2 ** (attempt - 1))
+                time.sleep(sleep_s)
+        raise RuntimeError(f"Embedding failed after {max_retries} attempts.") from last_err
+
+    def _embed_batch(self, batch):
+        """Embeds a batch; if it is rejected as invalid, splits it in half so one bad text doesn't sink the rest."""
+        try:
+            return self._embed_with_retry(batch)
+        except genai_errors.ClientError as e:
+            if e.code == 400 and len(batch) > 1:
+                mid = len(batch) // 2
+                return self._embed_batch(batch[:mid]) + self._embed_batch(batch[mid:])
+            err = e
+        except Exception as e:
+            err = e
+        print(f"Warning: failed embedding {len(batch)} chunk(s): {err}")
+        return [None] * len(batch)
+
+    def get_embeddings_batch(self, texts, batch_size=EMBED_BATCH_SIZE, max_in_flight=MAX_IN_FLIGHT_BATCHES):
+        """Generates embeddings for many texts, sending batches to Gemini from a thread pool.
+
+        Returns one embedding per input text, in order; failed texts map to None.
+        """
+        batches = list(self._iter_batches(texts, batch_size))
+        if not batches:
+            return []
+
+        # Threads are enough here: the GIL is released while waiting on the HTTP call
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            results = executor.map(self._embed_batch, batches)
+            return [embedding for result in results for embedding in result]
+
+    def _lookup_cached_embeddings(self, hashes):
+        """Returns {chunk_hash: embedding} for chunks already stored in the table."""
+        if not hashes:
+            return {}
+
+        with self.conn, self.conn.cursor() as cur:
+            cur.execute("EXECUTE lookup_embeddings (%s)", (list(set(hashes)),))
+            return dict(cur.fetchall())
+
+    def _copy_rows(self, cur, rows):
+        """Streams rows into the table with COPY, for files too large for batched INSERTs."""
+        buf = io.StringIO()
+        # Quote every field: QUOTE_MINIMAL leaves a lone "\r" unquoted, which COPY rejects
+        writer = csv.writer(buf, delimiter="\t", lineterminator="\n", quoting=csv.QUOTE_ALL)
+        for chunk, embedding, file_name, split_strategy, chunk_hash in rows:
+            writer.writerow((chunk, _to_pgvector(embedding), file_name, split_strategy, chunk_hash))
+        buf.seek(0)
+
+        cur.copy_expert(self._COPY_SQL, buf)
 
     def process_file(self, file_path):
         """Main pipeline: Extract -> Chunk -> Embed -> Save."""
         file_name = os.path.basename(file_path)
         print(f"Processing {file_name}...")
 
-        raw_text = self.extract_text(file_path)
+        chunks = list(self.iter_chunks(file_path))
 
-        if not raw_text or not raw_text.strip():
-            split_strategy = "empty_file"
-            insert_query = f"""
-            INSERT INTO {FULL_TABLE_NAME}
-            (chunk_text, embedding, file_name, split_strategy, created_at)
-            VALUES (%s, %s, %s, %s, %s)
-            """
+        if not chunks:
             with self.conn, self.conn.cursor() as cur:
-                cur.execute(insert_query, ("", [], file_name, split_strategy, datetime.datetime.now()))
+                cur.execute(self._INSERT_EMPTY_SQL, ("", None, file_name, "empty_file"))
             print(f"File {file_name} is empty; skipped embeddings.")
             return
 
-        chunks = self.chunk_text(raw_text)
         split_strategy = "paragraph_split_newline"
 
-        insert_query = f"""
-        INSERT INTO {FULL_TABLE_NAME}
-        (chunk_text, embedding, file_name, split_strategy, created_at)
-        VALUES (%s, %s, %s, %s, %s)
-        """
+        # Reuse embeddings for chunks seen before; only send the rest to Gemini
+        hashes = [_chunk_hash(chunk) for chunk in chunks]
+        cached = self._lookup_cached_embeddings(hashes)
+        embeddings = [cached.get(h) for h in hashes]
+        missing = [idx for idx, embedding in enumerate(embeddings) if embedding is None]
+        # Repeated paragraphs within the file share a single embedding request
+        unique = {}
+        for idx in missing:
+            unique.setdefault(hashes[idx], chunks[idx])
+        fresh = dict(zip(unique, self.get_embeddings_batch(list(unique.values()))))
+        for idx in missing:
+            embeddings[idx] = fresh[hashes[idx]]
 
-        inserted = 0
-        with self.conn, self.conn.cursor() as cur:
-            for idx, chunk in enumerate(chunks):
-                try:
-                    embedding = self.get_embedding(chunk)
-                    cur.execute(insert_query, (chunk, embedding, file_name, split_strategy, datetime.datetime.now()))
-                    inserted += 1
-                except Exception as e:
-                    print(f"Warning: failed processing chunk {idx} for {file_name}: {e}")
+        rows = []
+        for idx, (chunk, embedding, chunk_hash) in enumerate(zip(chunks, embeddings, hashes)):
+            if embedding is None:
+                print(f"Warning: skipping chunk {idx} for {file_name}: no embedding.")
+                continue
+            rows.append((chunk, embedding, file_name, split_strategy, chunk_hash))
+
+        # All writes go through one cursor and one transaction, committed once per file.
+        # Embedding happens before this, so no transaction is held open across API calls.
+        if rows:
+            with self.conn, self.conn.cursor() as cur:
+                if len(rows) >= COPY_MIN_ROWS:
+                    self._copy_rows(cur, rows)
+                else:
+                    execute_values(cur, self._INSERT_SQL, rows, page_size=500)
+        inserted = len(rows)
 
+        reused = len(chunks) - len(missing)
+        if reused:
+            print(f"Reused {reused} cached embeddings for {file_name}.")
         print(f"Successfully processed {inserted}/{len(chunks)} chunks for {file_name}.")
 
     def close(self):